@@ -0,0 +1,169 @@
+'''
+Shared code of the AIFS inference scripts and notebooks: input variables, download and regridding
+of the initial conditions from ECMWF Open Data.
+'''
+
+import datetime
+import hashlib
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+import earthkit.data as ekd
+
+from ecmwf.opendata import Client as OpendataClient
+
+# --- Definition of constants ---
+CACHE_FOLDER = "../data/cache"
+REGRID_BATCH_SIZE = 16 # number of fields regridded per sparse matmul
+
+# INPUT VARIABLE
+PARAM_SFC = ["10u", "10v", "2d", "2t", "msl", "skt", "sp", "tcw", "lsm", "z", "slor", "sdor"]
+# msl: Mean sea level pressure
+# skt: Skin temperature
+# sp: Surface pressure
+# tcw: Total column vertically-integrated water vapour
+# lsm: Land Sea Mask
+# z: Geopotential
+# slor: Slope of sub-gridscale orography (step 0)
+# sdor: Standard deviation of sub-gridscale orography (step 0)
+PARAM_SOIL =["vsw","sot"]
+# vsw: Volumetric soil water (layers 1-4)
+# sot: Soil temperature (layers 1-4)
+PARAM_PL = ["gh", "t", "u", "v", "w", "q"]
+# q: Specific humidity
+# w: vertical velocity
+LEVELS = [1000, 925, 850, 700, 600, 500, 400, 300, 250, 200, 150, 100, 50]
+SOIL_LEVELS = [1,2]
+
+## Date of initial conditions
+# Latest available date on ECMWF Open Data, unless set with AIFS_DATE=YYYYMMDDHH (e.g. to rerun a
+# cached date without any network access)
+if "AIFS_DATE" in os.environ:
+    DATE = datetime.datetime.strptime(os.environ["AIFS_DATE"], "%Y%m%d%H")
+else:
+    DATE = OpendataClient().latest()
+
+# Regridding weights, keyed by (source grid, target grid)
+_REGRID_CACHE = {}
+_REGRID_LOCK = threading.Lock()
+
+def get_regrid_matrix(grid_in, grid_out):
+    # The regridding from grid_in to grid_out is a fixed sparse matrix: look it up once
+    # in the earthkit-regrid matrix database and reuse it for every field. Across runs, earthkit-regrid
+    # already keeps the downloaded matrices in its own cache.
+    key = (grid_in, grid_out)
+    with _REGRID_LOCK:
+        if key not in _REGRID_CACHE:
+            from earthkit.regrid.db import find
+            matrix, shape = find({"grid": grid_in}, {"grid": grid_out}, "linear")
+            if matrix is None:
+                # ekr.interpolate relies on the same database, so there is nothing to fall back to
+                raise ValueError(f"No regridding matrix found for {grid_in} -> {grid_out}")
+            # float32 like the fields, so the matmul does not upcast them to float64
+            _REGRID_CACHE[key] = (matrix.tocsr().astype(np.float32), shape)
+        return _REGRID_CACHE[key]
+
+def regrid(values, grid_in, grid_out, out=None):
+    # Regrid a stack of fields (first axis), optionally writing into a preallocated array
+    matrix, shape = get_regrid_matrix(grid_in, grid_out)
+    if out is None:
+        out = np.empty((len(values),) + tuple(shape), dtype=values.dtype)
+    X = values.reshape(len(values), -1)
+    Y = out.reshape(len(values), -1)
+    # One sparse matmul per batch of fields, which bounds the size of the temporaries
+    for start in range(0, len(values), REGRID_BATCH_SIZE):
+        batch = slice(start, start + REGRID_BATCH_SIZE)
+        Y[batch] = (matrix @ np.ascontiguousarray(X[batch].T)).T
+    return out
+
+def _fetch_one_date(date, param, levelist):
+    data = ekd.from_source("ecmwf-open-data", date=date, param=param, levelist=levelist) # <class 'earthkit.data.readers.grib.file.GRIBReader'>
+    # Decode all the messages in one call, (n_fields, 721, 1440), directly as float32
+    arrs = data.to_numpy(dtype=np.float32)
+    assert arrs.shape[1:] == (721,1440)
+    # Shift the longitudes by half the width (-180..180 to 0..360) by swapping the two halves
+    half = arrs.shape[2] // 2
+    values = np.empty_like(arrs)
+    values[:, :, :half] = arrs[:, :, half:]
+    values[:, :, half:] = arrs[:, :, :half]
+
+    if levelist:
+        names = [f"{p}_{l}" for p, l in data.metadata(["param", "levelist"])]
+    else:
+        names = data.metadata("param")
+    return names, values
+
+def get_open_data(param, levelist=[]):
+    # Get data at time t and t-1, downloading both dates concurrently:
+    dates = [DATE - datetime.timedelta(hours=6), DATE]
+    with ThreadPoolExecutor(max_workers=len(dates)) as executor:
+        per_date = list(executor.map(lambda date: _fetch_one_date(date, param, levelist), dates))
+
+    # Interpolate the data to from 0.25°x0.25° (regular lat-lon grid, 2D) to N320 (reduced gaussian grid, 1D, see definition here: https://www.ecmwf.int/en/forecasts/documentation-and-support/gaussian_n320) 
+    # All the fields are regridded straight into a single (n_fields, n_dates, n_grid) block,
+    # and each parameter is a view into it.
+    names = per_date[0][0]
+    _, shape = get_regrid_matrix((0.25, 0.25), "N320")
+    block = np.empty((len(names), len(dates)) + tuple(shape), dtype=np.float32)
+    for i, (date_names, values) in enumerate(per_date):
+        if date_names != names:
+            values = values[[date_names.index(name) for name in names]]
+        regrid(values, (0.25, 0.25), "N320", out=block[:, i])
+
+    return {name: block[i] for i, name in enumerate(names)}
+
+def get_initial_conditions():
+    # The three parameter groups are downloaded concurrently
+    with ThreadPoolExecutor(max_workers=3) as executor:
+        sfc = executor.submit(get_open_data, param=PARAM_SFC)
+        pl = executor.submit(get_open_data, param=PARAM_PL, levelist=LEVELS)
+        soil = executor.submit(get_open_data, param=PARAM_SOIL, levelist=SOIL_LEVELS)
+        sfc, pl, soil = sfc.result(), pl.result(), soil.result()
+
+    fields = {}
+    fields.update(sfc)
+
+    fields.update(pl)
+    # Convert geopotential height into geopotential (transform GH to Z), all levels in one pass
+    gh = np.stack([fields.pop(f"gh_{level}") for level in LEVELS])
+    gh *= 9.80665
+    for i, level in enumerate(LEVELS):
+        fields[f"z_{level}"] = gh[i]
+
+    # soil parameters need to be renamed to be consistent with training
+    mapping = {'sot_1': 'stl1', 'sot_2': 'stl2',
+            'vsw_1': 'swvl1','vsw_2': 'swvl2'}
+    for k,v in soil.items():
+        fields[mapping[k]]=v
+
+    return fields
+
+def _cache_path(date):
+    # The key includes a digest of the requested variables, so changing them never reuses stale files
+    variables = repr((PARAM_SFC, PARAM_PL, LEVELS, PARAM_SOIL, SOIL_LEVELS))
+    digest = hashlib.md5(variables.encode()).hexdigest()[:8]
+    return os.path.join(CACHE_FOLDER, f"{date:%Y%m%d%H}_{digest}")
+
+def load_cached_fields(date):
+    # Memory-map the initial conditions saved by a previous run, if any
+    path = _cache_path(date)
+    if not os.path.isdir(path):
+        return None
+    return {name[:-len(".npy")]: np.load(os.path.join(path, name), mmap_mode="r")
+            for name in os.listdir(path) if name.endswith(".npy")}
+
+def save_cached_fields(date, fields):
+    # One .npy file per field, written to a temporary folder first so an interrupted run
+    # never leaves a partial cache behind
+    path = _cache_path(date)
+    tmp_path = f"{path}.tmp"
+    os.makedirs(tmp_path, exist_ok=True)
+    for name, values in fields.items():
+        np.save(os.path.join(tmp_path, f"{name}.npy"), values)
+    os.replace(tmp_path, path)
+
+def fix(lons):
+    # Shift the longitudes from 0-360 to -180-180
+    return np.where(lons > 180, lons - 360, lons)
@@ -0,0 +1,6 @@
+'''
+Stub of the flash_attn package, only needed to unpickle the AIFS checkpoint on machines without flash-attn.
+The processor using it is replaced by a 'scaled_dot_product_attention' one before inference.
+'''
+
+from flash_attn.flash_attn_interface import flash_attn_func
@@ -1,144 +1,126 @@
-import datetime
+import contextlib
+import importlib.util
 import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import torch
-from collections import defaultdict
-
-import earthkit.data as ekd
-import earthkit.regrid as ekr
+from torch.nn.attention import sdpa_kernel, SDPBackend
 
 import matplotlib.pyplot as plt
 import cartopy.crs as ccrs
 import cartopy.feature as cfeature
-import matplotlib.tri as tri
 
 from anemoi.inference.runners.simple import SimpleRunner
 from anemoi.inference.outputs.printer import print_state
 from anemoi.models.layers.processor import TransformerProcessor
-from ecmwf.opendata import Client as OpendataClient
-
-# Create dummy flash_attn package and submodule
-import sys
-import types
 
-# --- Create dummy flash_attn package ---
-flash_attn = types.ModuleType('flash_attn')
-flash_attn_interface = types.ModuleType('flash_attn_interface')
-
-# Dummy function to satisfy checkpoint
-def flash_attn_func(*args, **kwargs):
-    raise RuntimeError("This is a dummy flash_attn_func. Should not be called during inference with replaced processor.")
-
-flash_attn_interface.flash_attn_func = flash_attn_func
-
-# Register modules
-flash_attn.flash_attn_interface = flash_attn_interface
-sys.modules['flash_attn'] = flash_attn
-sys.modules['flash_attn.flash_attn_interface'] = flash_attn_interface
+from aifs_common import DATE, fix, get_initial_conditions, get_regrid_matrix, load_cached_fields, regrid, save_cached_fields
 
 # --- Definition of constants ---
 # SCRIPT CONSTANT
 RESULTS_FOLDER = "../reports/figures"
 EXPERIENCE = "inference_aifs_single-v1"
+PRECISION = "bf16" # autocast precision of the forecast, the weights are kept in float32
+NUM_LAYERS = 16
+NUM_CHUNKS = 1 # chunks only group the layers for activation checkpointing (training), one is enough for inference
+
+def build_processor(num_chunks):
+    return TransformerProcessor(
+        num_layers=NUM_LAYERS,
+        window_size=1024,
+        num_channels=1024,
+        num_chunks=num_chunks,
+        activation='GELU',
+        num_heads=16,
+        mlp_hidden_ratio=4,
+        dropout_p=0.0,
+        attention_implementation="scaled_dot_product_attention")
+
+def compile_processor(processor, device):
+    # Compile the processor to fuse the pointwise ops around attention and capture CUDA graphs.
+    # The compilation cost is paid once, on the first forecast step.
+    if device.type == "cuda":
+        return torch.compile(processor, mode="reduce-overhead", fullgraph=False, dynamic=False)
+    return processor
+
+def run_forecast(runner, input_state, device):
+    # Shapes are fixed across forecast steps, let cuDNN pick the fastest kernels,
+    # and allow TF32 for the matmuls still running in float32
+    torch.backends.cudnn.benchmark = True
+    torch.set_float32_matmul_precision("high")
+
+    # On CUDA, pin SDPA to the fused flash / memory-efficient kernels so it never falls back to
+    # the math kernel. On CPU PyTorch already picks its flash kernel by itself.
+    if device.type == "cuda":
+        sdpa_backends = sdpa_kernel([SDPBackend.FLASH_ATTENTION, SDPBackend.EFFICIENT_ATTENTION])
+    else:
+        sdpa_backends = contextlib.nullcontext()
+
+    with sdpa_backends, torch.inference_mode():
+        for state in runner.run(input_state=input_state, lead_time=12):
+            print_state(state)
+    return state
+
+def load_model(device):
+    # Modify model to NOT use flash-attn
+    # The checkpoint is memory-mapped on the CPU and only copied to the device once the processor
+    # has been swapped, so the flash-attn processor weights are never transferred.
+    model = torch.load("../data/aifs-single-mse-1.0.ckpt", map_location="cpu", weights_only=False, mmap=True)
+    model.model.processor = build_processor(NUM_CHUNKS)
 
-# INPUT VARIABLE
-PARAM_SFC = ["10u", "10v", "2d", "2t", "msl", "skt", "sp", "tcw", "lsm", "z", "slor", "sdor"]
-# msl: Mean sea level pressure
-# skt: Skin temperature
-# sp: Surface pressure
-# tcw: Total column vertically-integrated water vapour
-# lsm: Land Sea Mask
-# z: Geopotential
-# slor: Slope of sub-gridscale orography (step 0)
-# sdor: Standard deviation of sub-gridscale orography (step 0)
-PARAM_SOIL =["vsw","sot"]
-# vsw: Volumetric soil water (layers 1-4)
-# sot: Soil temperature (layers 1-4)
-PARAM_PL = ["gh", "t", "u", "v", "w", "q"]
-# q: Specific humidity
-# w: vertical velocity
-LEVELS = [1000, 925, 850, 700, 600, 500, 400, 300, 250, 200, 150, 100, 50]
-SOIL_LEVELS = [1,2]
-
-## Date of initial conditions
-DATE = OpendataClient().latest()
-
-def get_open_data(param, levelist=[]):
-    fields = defaultdict(list)
-    # Get data at time t and t-1:
-    for date in [DATE - datetime.timedelta(hours=6), DATE]:
-        data = ekd.from_source("ecmwf-open-data", date=date, param=param, levelist=levelist) # <class 'earthkit.data.readers.grib.file.GRIBReader'>
-        for f in data:  # <class 'earthkit.data.readers.grib.codes.GribField'>
-            assert f.to_numpy().shape == (721,1440)
-            values = np.roll(f.to_numpy(), -f.shape[1] // 2, axis=1)
-            # Interpolate the data to from 0.25°x0.25° (regular lat-lon grid, 2D) to N320 (reduced gaussian grid, 1D, see definition here: https://www.ecmwf.int/en/forecasts/documentation-and-support/gaussian_n320) 
-            values = ekr.interpolate(values, {"grid": (0.25, 0.25)}, {"grid": "N320"})
-            # Add the values to the list
-            name = f"{f.metadata('param')}_{f.metadata('levelist')}" if levelist else f.metadata("param")
-            fields[name].append(values)
-
-    # Create a single matrix for each parameter
-    for param, values in fields.items():
-        fields[param] = np.stack(values)
-
-    return fields
-
-def fix(lons):
-    # Shift the longitudes from 0-360 to -180-180
-    return np.where(lons > 180, lons - 360, lons)
+    # Runs in a background thread of __main__, so the copy to the device overlaps the data download
+    return model.to(device)
 
 if __name__ == "__main__":
     # Create necessary dir
     os.makedirs(RESULTS_FOLDER, exist_ok=True)
 
-    ## Import initial conditions from ECMWF Open Data
-    fields = {}
-    fields.update(get_open_data(param=PARAM_SFC))
+    print(' > CUDA availability: ', torch.cuda.is_available())
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    fields.update(get_open_data(param=PARAM_PL, levelist=LEVELS))
-    # Convert geopotential height into geopotential (transform GH to Z)
-    for level in LEVELS:
-        gh = fields.pop(f"gh_{level}")
-        fields[f"z_{level}"] = gh * 9.80665
-        
-    soil=get_open_data(param=PARAM_SOIL,levelist=SOIL_LEVELS)
+    # Unpickling the checkpoint needs flash_attn: without the real package, add the stub package in
+    # flash_attn_stub/ to the path. This must only happen after anemoi is imported, anemoi picks its
+    # attention function at import time and would otherwise select the (dummy) flash_attn_func.
+    if importlib.util.find_spec("flash_attn") is None:
+        sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "flash_attn_stub"))
 
-    # soil parameters need to be renamed to be consistent with training
-    mapping = {'sot_1': 'stl1', 'sot_2': 'stl2',
-            'vsw_1': 'swvl1','vsw_2': 'swvl2'}
-    for k,v in soil.items():
-        fields[mapping[k]]=v
+    # Look up the N320 -> 0.25° matrix used by the plot now, so a missing matrix fails before the forecast
+    get_regrid_matrix("N320", (0.25, 0.25))
 
-    print(" > data downloaded! ")
+    ## Import initial conditions from ECMWF Open Data (or from the local cache),
+    # while the checkpoint is loaded and transferred to the device in the background
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        model = executor.submit(load_model, device)
+
+        fields = load_cached_fields(DATE)
+        if fields is None:
+            fields = get_initial_conditions()
+            save_cached_fields(DATE, fields)
+            print(" > data downloaded! ")
+        else:
+            print(" > data loaded from cache! ")
 
     # Create initial state
     input_state = dict(date=DATE, fields=fields)
 
     ## Load the model and run the forecast
     checkpoint = {"huggingface":"ecmwf/aifs-single-1.0"}
-    print(' > CUDA availability: ', torch.cuda.is_available())
-
-    # Modify model to NOT use flash-attn
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
-    model = torch.load("../data/aifs-single-mse-1.0.ckpt", map_location=device, weights_only=False).to(device)
-    model.model.processor = TransformerProcessor(
-        num_layers=16,
-        window_size=1024,
-        num_channels=1024,
-        num_chunks=2,
-        activation='GELU',
-        num_heads=16,
-        mlp_hidden_ratio=4,
-        dropout_p=0.0,
-        attention_implementation="scaled_dot_product_attention").to(device)
 
+    model = model.result()
     print(" > Model modified to use 'scaled_dot_product_attention'.")
-    runner = SimpleRunner(checkpoint, device="cuda")
+
+    model.model.processor = compile_processor(model.model.processor, device)
+    # The runner wraps each step in its own torch.autocast, so the precision is set there
+    runner = SimpleRunner(checkpoint, device="cuda", precision=PRECISION)
     runner.model = model
 
     # Run the forecast
-    for state in runner.run(input_state=input_state, lead_time=12):
-        print_state(state)
+    state = run_forecast(runner, input_state, device)
+
+    if device.type == "cuda":
+        peak = torch.cuda.max_memory_allocated(device) / torch.cuda.get_device_properties(device).total_memory
+        print(f" > Peak GPU memory: {peak:.0%} of the device")
 
     ## Plot generation
     DISP_VAR = "100u"
@@ -165,10 +147,14 @@ if __name__ == "__main__":
     ax.coastlines()
     ax.add_feature(cfeature.BORDERS, linestyle=":")
 
-    triangulation = tri.Triangulation(fix(longitudes), latitudes)
+    # Regrid back to the regular 0.25°x0.25° grid and shift the longitudes from 0-360 to -180-180,
+    # so the field can be drawn as an image instead of triangulating the N320 points
+    # (the extent is given by the outer edges of the cells, half a grid step around the grid points)
+    raster = regrid(np.asarray(values, dtype=np.float32)[None], "N320", (0.25, 0.25))[0]
+    raster = np.concatenate([raster[:, raster.shape[1] // 2:], raster[:, :raster.shape[1] // 2]], axis=1)
 
-    contour=ax.tricontourf(triangulation, values, levels=20, transform=ccrs.PlateCarree(), cmap="RdBu")
-    cbar = fig.colorbar(contour, ax=ax, orientation="vertical", shrink=0.7, label="100u")
+    image = ax.imshow(raster, extent=[-180.125, 179.875, -90.125, 90.125], origin="upper", transform=ccrs.PlateCarree(), cmap="RdBu")
+    cbar = fig.colorbar(image, ax=ax, orientation="vertical", shrink=0.7, label="100u")
 
     plt.title("100m winds (100u) at {}".format(state["date"]))
     plt.savefig(os.path.join(RESULTS_FOLDER, f"{EXPERIENCE}_{DISP_VAR}_{DATE}"), )